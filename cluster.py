@@ -1,10 +1,44 @@
 import pandas as pd
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
+import numpy as np
 import argparse
 
 
-def cluster_environmental(df, features=None, n_clusters=4):
+def standardize(X):
+    # Same scaling as StandardScaler: zero mean and unit (population) variance per column
+    mean = X.mean(axis=0)
+    std = X.std(axis=0)
+    std[std == 0] = 1.0
+    return (X - mean) / std
+
+
+CLUSTER_ALGOS = ['faiss', 'faiss-gpu', 'minibatch']
+
+
+def fit_cluster_labels(X, n_clusters, algo='faiss'):
+    if algo == 'minibatch':
+        # Imported per backend, so each run only needs the library it actually uses
+        from sklearn.cluster import MiniBatchKMeans
+
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=4096, n_init=3, random_state=42)
+        return kmeans.fit_predict(X)
+
+    if algo not in ('faiss', 'faiss-gpu'):
+        raise ValueError(f"Unknown clustering algorithm: {algo} (expected one of {CLUSTER_ALGOS})")
+
+    import faiss
+
+    if algo == 'faiss-gpu' and faiss.get_num_gpus() == 0:
+        # faiss.Kmeans(gpu=True) silently falls back to the CPU when no GPU is visible
+        raise ValueError("--algo faiss-gpu needs a GPU build of faiss and a visible GPU; use --algo faiss instead")
+
+    # FAISS runs the Lloyd iterations on BLAS/SIMD kernels, or on CUDA with faiss-gpu
+    kmeans = faiss.Kmeans(d=X.shape[1], k=n_clusters, niter=20, seed=42, gpu=(algo == 'faiss-gpu'))
+    kmeans.train(X)
+    _, labels = kmeans.index.search(X, 1)
+    return labels.ravel()
+
+
+def cluster_environmental(df, features=None, n_clusters=4, algo='faiss'):
     if features is None:
         features = [
             'ndvi',
@@ -15,13 +49,11 @@ def cluster_environmental(df, features=None, n_clusters=4):
     # Drop rows with missing values in those features
     df_cluster = df.dropna(subset=features).copy()
 
-    # Normalize the data
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(df_cluster[features])
+    # Normalize the data (FAISS works on contiguous float32)
+    X_scaled = np.ascontiguousarray(standardize(df_cluster[features].to_numpy(dtype='float32')))
 
     # Fit KMeans
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    df_cluster['cluster'] = kmeans.fit_predict(X_scaled)
+    df_cluster['cluster'] = fit_cluster_labels(X_scaled, n_clusters, algo=algo)
 
     # Merge back into original DataFrame
     df = df.merge(df_cluster[['uuid', 'cluster']], on='uuid', how='left')
@@ -29,20 +61,34 @@ def cluster_environmental(df, features=None, n_clusters=4):
     return df
 
 
+def read_table(path):
+    if path.endswith(".csv"):
+        return pd.read_csv(path)
+    return pd.read_parquet(path)
+
+
+def write_table(df, path):
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False)
+    else:
+        df.to_parquet(path, engine="pyarrow", compression="snappy", index=False)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Cluster mushroom observations by environmental similarity")
-    parser.add_argument("--input", default="mushroom_observations_enriched.csv", help="Path to enriched CSV file")
-    parser.add_argument("--output", default="mushroom_clusters.csv", help="Output CSV with cluster labels")
+    parser.add_argument("--input", default="mushroom_observations_enriched.parquet", help="Path to enriched Parquet (or CSV) file")
+    parser.add_argument("--output", default="mushroom_clusters.parquet", help="Output Parquet (or CSV) file with cluster labels")
     parser.add_argument("--clusters", type=int, default=4, help="Number of clusters to form")
+    parser.add_argument("--algo", choices=CLUSTER_ALGOS, default="faiss", help="K-means implementation to use")
     args = parser.parse_args()
 
     print(f"📂 Loading {args.input}...")
-    df = pd.read_csv(args.input)
+    df = read_table(args.input)
 
-    df = cluster_environmental(df, n_clusters=args.clusters)
+    df = cluster_environmental(df, n_clusters=args.clusters, algo=args.algo)
 
     print(f"💾 Saving with clusters to {args.output}...")
-    df.to_csv(args.output, index=False)
+    write_table(df, args.output)
     print("✅ Done.")
 
 
@@ -1,12 +1,16 @@
 import pandas as pd
 from datetime import timedelta
 import rasterio
-from rasterio.warp import transform
+from rasterio.warp import transform, calculate_default_transform, reproject, Resampling
+from rasterio.windows import Window
 import xarray as xr
 import numpy as np
-import math
 import os
+import math
 import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 # ─── Raster Data Sources ────────────────────────────────────────────────────────
 # https://worldcover2020.esa.int/downloader
@@ -15,34 +19,148 @@ import shutil
 # 
 # https://msc.fema.gov/portal/search?AddressQuery=-105.0%2C%2040.0
 
-# ─── Utility Function to Sample Raster Value ──────────────────────────────────
+# ─── Raster Handle Cache ──────────────────────────────────────────────────────
+
+RASTER_CACHE_SIZE = 16
+MAX_WINDOW_PIXELS = 4096 * 4096  # largest single window read when sampling a batch
+_raster_cache = OrderedDict()
 
-def sample_raster_value(tif_path, lon, lat, scale_factor=1.0, nodata_val=None):
+def reprojected_path(tif_path):
+    return os.path.splitext(tif_path)[0] + "_4326.tif"
+
+def open_raster(tif_path):
     """
-    Samples a raster file at the given longitude and latitude.
-    Optionally applies a scale factor and respects a nodata value.
+    Returns an open dataset for tif_path, reusing the handle across calls.
+    An EPSG:4326 copy written by preprocess_rasters is used instead when present.
+    The least recently used handle is closed once more than RASTER_CACHE_SIZE are open.
     """
-    try:
+    src = _raster_cache.pop(tif_path, None)
+    if src is None:
+        path_4326 = reprojected_path(tif_path)
+        src = rasterio.open(path_4326 if os.path.exists(path_4326) else tif_path)
+    _raster_cache[tif_path] = src
+
+    while len(_raster_cache) > RASTER_CACHE_SIZE:
+        _, stale = _raster_cache.popitem(last=False)
+        stale.close()
+    return src
+
+def close_rasters():
+    while _raster_cache:
+        _, src = _raster_cache.popitem()
+        src.close()
+
+def preprocess_rasters(raster_dir, resampling=Resampling.bilinear):
+    """
+    Writes an EPSG:4326 copy ({name}_4326.tif) of every GeoTIFF in raster_dir that uses another CRS.
+    Sampling those copies needs no coordinate transform per batch.
+    Pass Resampling.nearest for categorical rasters such as land cover.
+    """
+    for name in sorted(os.listdir(raster_dir)):
+        if not name.endswith('.tif') or name.endswith('_4326.tif'):
+            continue
+        tif_path = os.path.join(raster_dir, name)
+        out_path = reprojected_path(tif_path)
+        if os.path.exists(out_path):
+            continue
+
         with rasterio.open(tif_path) as src:
-            x, y = transform('EPSG:4326', src.crs, [lon], [lat])
-            row, col = src.index(x[0], y[0])
+            if src.crs == 'EPSG:4326':
+                continue
 
-            if not (0 <= row < src.height and 0 <= col < src.width):
-                print(f"[!] Point ({lat}, {lon}) is outside raster bounds of {tif_path}")
-                return None
+            print(f"  ↻ Reprojecting {tif_path} to EPSG:4326")
+            dst_transform, width, height = calculate_default_transform(
+                src.crs, 'EPSG:4326', src.width, src.height, *src.bounds
+            )
+            profile = src.profile.copy()
+            profile.update(crs='EPSG:4326', transform=dst_transform, width=width, height=height)
+
+            with rasterio.open(out_path, 'w', **profile) as dst:
+                for band in range(1, src.count + 1):
+                    reproject(
+                        source=rasterio.band(src, band),
+                        destination=rasterio.band(dst, band),
+                        src_nodata=src.nodata,
+                        dst_nodata=src.nodata,
+                        resampling=resampling,
+                        num_threads=os.cpu_count(),
+                    )
 
-            value = src.read(1)[row, col]
+# ─── Utility Function to Sample Raster Value ──────────────────────────────────
 
-            # Apply nodata masking if defined
-            if nodata_val is not None and value == nodata_val:
-                return None
-            if src.nodata is not None and value == src.nodata:
-                return None
+_last_reprojection = {}
 
-            return value * scale_factor
+def reproject_points(crs, lons, lats):
+    """
+    Transforms lon/lat arrays into crs with one batched PROJ call.
+    The last result is kept, so the 7 precip rasters for a date reproject their shared points only once.
+    """
+    key = (str(crs), lons.tobytes(), lats.tobytes())
+    if key not in _last_reprojection:
+        xs, ys = transform('EPSG:4326', crs, lons, lats)
+        _last_reprojection.clear()
+        _last_reprojection[key] = (np.asarray(xs), np.asarray(ys))
+    return _last_reprojection[key]
+
+def sample_raster_values(tif_path, lons, lats, scale_factor=1.0, nodata_val=None):
+    """
+    Samples a raster file at arrays of longitudes and latitudes.
+    The file is opened once and all points are reprojected and sampled as one batch.
+    Optionally applies a scale factor and respects a nodata value.
+    Returns a float32 array with NaN wherever a point has no value.
+    """
+    lons = np.asarray(lons, dtype='float64')
+    lats = np.asarray(lats, dtype='float64')
+    values = np.full(len(lons), np.nan, dtype='float32')
+    if len(lons) == 0:
+        return values
+
+    try:
+        src = open_raster(tif_path)
+        if src.crs == 'EPSG:4326':
+            xs, ys = lons, lats
+        else:
+            xs, ys = reproject_points(src.crs, lons, lats)
+        # Inverse affine gives fractional pixel coordinates for the whole batch at once
+        cols, rows = ~src.transform * (xs, ys)
+        rows = np.floor(rows).astype('int64')
+        cols = np.floor(cols).astype('int64')
+
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        for lon, lat in zip(lons[~inside], lats[~inside]):
+            print(f"[!] Point ({lat}, {lon}) is outside raster bounds of {tif_path}")
+        if not inside.any():
+            return values
+
+        rows, cols = rows[inside], cols[inside]
+        row_off, col_off = rows.min(), cols.min()
+        height, width = rows.max() - row_off + 1, cols.max() - col_off + 1
+
+        # A shared window only pays off while it is no larger than the blocks the points would touch anyway
+        block_height, block_width = src.block_shapes[0]
+        window_budget = min(MAX_WINDOW_PIXELS, len(rows) * block_height * block_width)
+        if height * width <= window_budget:
+            # One read covering every point, then a single vectorized gather
+            block = src.read(1, window=Window(col_off, row_off, width, height))
+            sampled = block[rows - row_off, cols - col_off]
+        else:
+            # Points too sparse for one window: let rasterio read only the blocks they fall in
+            sampled = np.fromiter(
+                (v[0] for v in src.sample(zip(xs[inside], ys[inside]), indexes=1)),
+                dtype=src.dtypes[0],
+                count=len(rows),
+            )
+
+        # Apply nodata masking and scaling in the same pass over the raw values
+        valid = np.ones(len(sampled), dtype=bool)
+        if nodata_val is not None:
+            valid &= sampled != nodata_val
+        if src.nodata is not None:
+            valid &= sampled != src.nodata
+        values[inside] = np.where(valid, sampled * scale_factor, np.nan)
     except Exception as e:
-        print(f"[!] Error sampling raster at ({lon}, {lat}) in {tif_path}: {e}")
-        return None
+        print(f"[!] Error sampling raster {tif_path} at {len(lons)} points: {e}")
+    return values
 
 def get_needed_raster_dates(df, buffer_days=6):
     if 'date' not in df.columns:
@@ -55,61 +173,106 @@ def get_needed_raster_dates(df, buffer_days=6):
 
     return sorted(all_dates)
 
+def group_rows_by_date(df):
+    """
+    Maps each observation date (YYYY-MM-DD) to the positions of its rows, in date order.
+    Built from a single groupby pass rather than one boolean mask per date.
+    """
+    dates = pd.to_datetime(df['date'])
+    return {date.strftime('%Y-%m-%d'): pos for date, pos in sorted(dates.groupby(dates).indices.items())}
+
+def date_chunksize(n_dates, max_workers=None):
+    """
+    Splits the sorted dates into one contiguous run per worker process.
+    Neighbouring dates share rasters (6 of 7 precip files overlap), and each worker has its
+    own handle cache, so keeping runs together lets a worker reuse the files it already opened.
+    """
+    workers = max_workers or os.cpu_count() or 1
+    return max(1, math.ceil(n_dates / workers))
+
 # ─── Precipitation Utilities ──────────────────────────────────────────────────
-def enrich_with_precip(df, precip_dir="precip/"):
-    print("Adding 7-day precipitation history...")
+def sample_precip_history(date_str, lons, lats, precip_dir="precip/"):
+    """
+    Samples the 7 daily precip rasters ending on date_str at every point.
+    Returns a (7, n_points) array where row d holds the d-day offset.
+    """
+    print(f"  → Enriching precip data for {date_str} ({len(lons)} rows)")
+    date = pd.Timestamp(date_str)
+    history = np.full((7, len(lons)), np.nan, dtype='float32')
+
     for d in range(7):
-        col_name = f'prcp_d{d}'
-        df[col_name] = None
+        target_date = (date - timedelta(days=d)).strftime('%Y-%m-%d')
+        # tif_path = os.path.join(precip_dir, f"precip_sample.tif")
+        tif_path = os.path.join(precip_dir, f"precip_{target_date}.tif")
 
-    unique_dates = pd.to_datetime(df['date'].dropna().unique())
+        if not os.path.exists(tif_path):
+            print(f"[!] Precip raster missing: {tif_path}")
+            continue
 
-    for date in unique_dates:
-        print(f"  → Enriching precip data for {date.strftime('%Y-%m-%d')} ({len(df[df['date'] == date.strftime('%Y-%m-%d')])} rows)")
-        for d in range(7):
-            target_date = (date - timedelta(days=d)).strftime('%Y-%m-%d')
-            # tif_path = os.path.join(precip_dir, f"precip_sample.tif")
-            tif_path = os.path.join(precip_dir, f"precip_{target_date}.tif")
+        # print(f"  ✓ Using {tif_path} for {d}-day offset")
+        history[d] = sample_raster_values(tif_path, lons, lats)
 
-            if not os.path.exists(tif_path):
-                print(f"[!] Precip raster missing: {tif_path}")
-                continue
+    return history
 
-            # print(f"  ✓ Using {tif_path} for {d}-day offset")
-            for idx, row in df[df['date'] == date.strftime('%Y-%m-%d')].iterrows():
-                val = sample_raster_value(tif_path, row.lon, row.lat)
-                df.at[idx, f'prcp_d{d}'] = val
+def enrich_with_precip(df, precip_dir="precip/", max_workers=None):
+    print("Adding 7-day precipitation history...")
+    precip_cols = [f'prcp_d{d}' for d in range(7)]
+    for col_name in precip_cols:
+        df[col_name] = np.full(len(df), np.nan, dtype='float32')
+
+    date_groups = group_rows_by_date(df)
+    lons = df['lon'].to_numpy()
+    lats = df['lat'].to_numpy()
+
+    # Each date only reads its own rasters, so dates are sampled in parallel
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        histories = executor.map(
+            sample_precip_history,
+            date_groups.keys(),
+            [lons[pos] for pos in date_groups.values()],
+            [lats[pos] for pos in date_groups.values()],
+            repeat(precip_dir),
+            chunksize=date_chunksize(len(date_groups), max_workers),
+        )
+        for pos, history in zip(date_groups.values(), histories):
+            df.loc[df.index[pos], precip_cols] = history.T
 
     return df
 
 # ─── Land Cover Utilities ──────────────────────────────────────────────────
-def get_worldcover_tile_name(lat, lon):
+def get_worldcover_tile_names(lats, lons):
     # These tiles start at whole degrees divisible by 3
-    lat_deg = math.floor(lat / 3) * 3
-    lon_deg = math.floor(lon / 3) * 3
+    lat_deg = (np.floor(lats / 3) * 3).astype('int64')
+    lon_deg = (np.floor(lons / 3) * 3).astype('int64')
 
-    lat_prefix = "N" if lat_deg >= 0 else "S"
-    lon_prefix = "E" if lon_deg >= 0 else "W"
-    lat_str = f"{abs(lat_deg):02d}"
-    lon_str = f"{abs(lon_deg):03d}"
-    return f"ESA_WorldCover_10m_2020_v100_{lat_prefix}{lat_str}{lon_prefix}{lon_str}_Map.tif"
+    lat_prefix = np.where(lat_deg >= 0, "N", "S")
+    lon_prefix = np.where(lon_deg >= 0, "E", "W")
+    lat_str = lat_deg.abs().astype(str).str.zfill(2)
+    lon_str = lon_deg.abs().astype(str).str.zfill(3)
+    return "ESA_WorldCover_10m_2020_v100_" + lat_prefix + lat_str + lon_prefix + lon_str + "_Map.tif"
 
 def enrich_with_worldcover(df, base_dir="./world_cover/"):
     print("Adding WorldCover land class...")
-    df['land_cover'] = None
+    land_cover = pd.Series(np.nan, index=df.index, dtype='float32')
 
-    for idx, row in df.iterrows():
-        tile_name = get_worldcover_tile_name(row.lat, row.lon)
+    located = df.dropna(subset=['lat', 'lon'])
+    tile_names = get_worldcover_tile_names(located['lat'], located['lon'])
+
+    # Group by tile so each tile is opened once and sampled in one batch
+    for tile_name, tile_df in located.groupby(tile_names):
         tile_path = os.path.join(base_dir, tile_name)
 
         if not os.path.exists(tile_path):
-            print(f"[!] Tile not found: {tile_path}")
+            print(f"[!] Tile not found: {tile_path} ({len(tile_df)} rows)")
             continue
 
-        print(f"  ✓ Using {tile_path} for ({row.lat}, {row.lon})")
-        val = sample_raster_value(tile_path, row.lon, row.lat, scale_factor=1, nodata_val=255)
-        df.at[idx, 'land_cover'] = val
+        print(f"  ✓ Using {tile_path} for {len(tile_df)} rows")
+        vals = sample_raster_values(tile_path, tile_df['lon'], tile_df['lat'], scale_factor=1, nodata_val=255)
+        land_cover.loc[tile_df.index] = vals
 
+    # Keep only the known class codes as a nullable UInt8, which survives a Parquet round-trip
+    land_cover = land_cover.where(land_cover.isin(list(ESA_WORLDCOVER_CLASSES)))
+    df['land_cover'] = land_cover.astype('UInt8')
     return df
 
 ESA_WORLDCOVER_CLASSES = {
@@ -135,7 +298,11 @@ def add_worldcover_labels(df):
 def load_soil_moisture_dataset(nc_path):
     return xr.open_dataset(nc_path, engine='netcdf4')
 
-def extract_soil_moisture(ds, lat, lon, date_str):
+def extract_soil_moisture(ds, lats, lons, date_str):
+    """
+    Interpolates surface soil moisture at many points on one date in a single call.
+    Returns a float32 array aligned with lats/lons.
+    """
     try:
         date = np.datetime64(date_str)
         if 'time' in ds.dims:
@@ -146,107 +313,125 @@ def extract_soil_moisture(ds, lat, lon, date_str):
             raise ValueError(f"No recognizable time dimension in dataset: {ds.dims}")
 
         ds_time = ds.sel({time_dim: date}, method="nearest")
-        value = ds_time['swvl1'].interp(latitude=lat, longitude=lon).values.item()
-        return value
+        # Shared 'points' dim makes interp pointwise instead of building a lat x lon grid
+        points_lat = xr.DataArray(np.asarray(lats, dtype='float64'), dims='points')
+        points_lon = xr.DataArray(np.asarray(lons, dtype='float64'), dims='points')
+        values = ds_time['swvl1'].interp(latitude=points_lat, longitude=points_lon).values
+        return values.astype('float32')
     except Exception as e:
-        print(f"[!] Soil moisture not found for ({lat}, {lon}) on {date_str}: {e}")
-        return None
+        print(f"[!] Soil moisture not found for {len(lats)} points on {date_str}: {e}")
+        return np.full(len(lats), np.nan, dtype='float32')
 
 # ─── NDVI Utilities ───────────────────────────────────────────────────────────
 
-def get_ndvi_from_raster(tif_path, lon, lat):
-    try:
-        with rasterio.open(tif_path) as src:
-            x, y = transform('EPSG:4326', src.crs, [lon], [lat])
-            row, col = src.index(x[0], y[0])
-            ndvi_value = src.read(1)[row, col]
-            if ndvi_value != src.nodata:
-                return ndvi_value / 10000.0
-    except Exception as e:
-        print(f"[!] NDVI missing for ({lat}, {lon}) in {tif_path}: {e}")
-    return None
+def get_ndvi_from_raster(tif_path, lons, lats):
+    return sample_raster_values(tif_path, lons, lats, scale_factor=1 / 10000.0)
 
-def fill_missing_ndvi(df, max_days_gap=7):
-    filled = 0
+def fill_missing_ndvi(df, max_days_gap=7, location_decimals=6):
     df['date'] = pd.to_datetime(df['date'])
     df = df.sort_values('date')
 
-    for idx, row in df[df['ndvi'].isnull()].iterrows():
-        lat = row['lat']
-        lon = row['lon']
-        date = row['date']
-
-        # Look for exact same location
-        candidates = df[
-            (df['ndvi'].notnull()) &
-            (df['lat'] == lat) &
-            (df['lon'] == lon)
-        ].copy()
-
-        if candidates.empty:
-            continue
-
-        # Find nearest date within allowed window
-        candidates['date_diff'] = candidates['date'].apply(lambda d: abs((d - date).days))
-        nearest = candidates[candidates['date_diff'] <= max_days_gap].sort_values('date_diff')
-
-        if not nearest.empty:
-            fill_val = nearest.iloc[0]['ndvi']
-            df.at[idx, 'ndvi'] = fill_val
-            filled += 1
+    # Match locations on rounded coordinates (~0.1 m at 6 decimals) rather than exact float equality
+    located = df.dropna(subset=['lat', 'lon', 'date'])
+    located = located.assign(
+        lat_key=located['lat'].round(location_decimals),
+        lon_key=located['lon'].round(location_decimals),
+    )
+    # Carry the row labels explicitly so the write-back doesn't depend on the index name
+    missing = located.loc[located['ndvi'].isnull(), ['lat_key', 'lon_key', 'date']]
+    missing = missing.assign(row=missing.index).reset_index(drop=True)
+    known = located.loc[located['ndvi'].notnull(), ['lat_key', 'lon_key', 'date', 'ndvi']]
+
+    # Nearest known date at the same location, within the allowed window
+    merged = pd.merge_asof(
+        missing,
+        known,
+        on='date',
+        by=['lat_key', 'lon_key'],
+        tolerance=pd.Timedelta(days=max_days_gap),
+        direction='nearest',
+    ).dropna(subset=['ndvi'])
+
+    df.loc[merged['row'], 'ndvi'] = merged['ndvi'].to_numpy()
+    filled = len(merged)
 
     print(f"✅ Filled {filled} NDVI values using same-location fallback.")
     return df
 
 # ─── Main Enrichment Script ───────────────────────────────────────────────────
 
-def enrich_df_with_rasters(df, ndvi_dir='ndvi/', soil_dir='soil/'):
-    df['ndvi'] = None
-    df['soil_moisture'] = None
-
-    unique_dates = sorted(set(df['date'].dropna()))
-    print(f"Processing {len(unique_dates)} unique dates...")
-
-    for date_str in unique_dates:
-        date_df = df[df['date'] == date_str]
-        print(f"→ Enriching data for {date_str} ({len(date_df)} rows)")
-
-        # Construct expected filenames
-        lat = date_df['lat'].iloc[0]
-        lon = date_df['lon'].iloc[0]
-        ndvi_path = os.path.join(ndvi_dir, f"ndvi_{date_str}_{lat:.4f}_{lon:.4f}.tif")
-        soil_path = os.path.join(soil_dir, f"soil_{date_str}.nc")
-
-        # Check existence
-        has_ndvi = os.path.exists(ndvi_path)
-        has_soil = os.path.exists(soil_path)
-
-        if not has_ndvi and not has_soil:
-            print(f"[!] Skipping {date_str}: no NDVI or soil file found")
-            continue
-
-        if has_ndvi:
-            print(f"  ✓ NDVI file found: {ndvi_path}")
-        if has_soil:
-            print(f"  ✓ Soil file found: {soil_path}")
-            soil_ds = load_soil_moisture_dataset(soil_path)
-
-        for idx, row in df[df['date'] == date_str].iterrows():
-            if has_ndvi:
-                df.at[idx, 'ndvi'] = get_ndvi_from_raster(ndvi_path, row.lon, row.lat)
-            if has_soil:
-                df.at[idx, 'soil_moisture'] = extract_soil_moisture(soil_ds, row.lat, row.lon, row.date)
+def process_date(date_str, lons, lats, ndvi_dir='ndvi/', soil_dir='soil/'):
+    """
+    Samples NDVI and soil moisture for every observation on one date.
+    Returns (ndvi, soil_moisture) arrays aligned with lons/lats, NaN where no data was found.
+    """
+    print(f"→ Enriching data for {date_str} ({len(lons)} rows)")
+    ndvi = np.full(len(lons), np.nan, dtype='float32')
+    soil_moisture = np.full(len(lons), np.nan, dtype='float32')
+
+    # Construct expected filenames
+    ndvi_path = os.path.join(ndvi_dir, f"ndvi_{date_str}_{lats[0]:.4f}_{lons[0]:.4f}.tif")
+    soil_path = os.path.join(soil_dir, f"soil_{date_str}.nc")
+
+    # Check existence
+    has_ndvi = os.path.exists(ndvi_path)
+    has_soil = os.path.exists(soil_path)
+
+    if not has_ndvi and not has_soil:
+        print(f"[!] Skipping {date_str}: no NDVI or soil file found")
+        return ndvi, soil_moisture
+
+    if has_ndvi:
+        print(f"  ✓ NDVI file found: {ndvi_path}")
+        ndvi = get_ndvi_from_raster(ndvi_path, lons, lats)
+    if has_soil:
+        print(f"  ✓ Soil file found: {soil_path}")
+        with load_soil_moisture_dataset(soil_path) as soil_ds:
+            soil_moisture = extract_soil_moisture(soil_ds, lats, lons, date_str)
+
+    return ndvi, soil_moisture
+
+def enrich_df_with_rasters(df, ndvi_dir='ndvi/', soil_dir='soil/', max_workers=None):
+    df['ndvi'] = np.full(len(df), np.nan, dtype='float32')
+    df['soil_moisture'] = np.full(len(df), np.nan, dtype='float32')
+
+    date_groups = group_rows_by_date(df)
+    print(f"Processing {len(date_groups)} unique dates...")
+    lons = df['lon'].to_numpy()
+    lats = df['lat'].to_numpy()
+
+    # Dates are independent (different files, different rows), so fan them out across processes
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            process_date,
+            date_groups.keys(),
+            [lons[pos] for pos in date_groups.values()],
+            [lats[pos] for pos in date_groups.values()],
+            repeat(ndvi_dir),
+            repeat(soil_dir),
+            chunksize=date_chunksize(len(date_groups), max_workers),
+        )
+        for pos, (ndvi, soil_moisture) in zip(date_groups.values(), results):
+            idx = df.index[pos]
+            df.loc[idx, 'ndvi'] = ndvi
+            df.loc[idx, 'soil_moisture'] = soil_moisture
 
     return df
 
 # ─── Script Entrypoint ────────────────────────────────────────────────────────
 
 if __name__ == "__main__":
-    input_file = "mushroom_observations.csv"
-    output_file = "mushroom_observations_enriched.csv"
+    input_file = "mushroom_observations.parquet"
+    output_file = "mushroom_observations_enriched.parquet"
 
     print(f"Loading {input_file}...")
-    df = pd.read_csv(input_file)
+    if os.path.exists(input_file):
+        df = pd.read_parquet(input_file, engine='pyarrow')
+    else:
+        input_file = "mushroom_observations.csv"
+        print(f"[!] Parquet not found, falling back to {input_file}")
+        # The pyarrow engine parses on several threads and reads 'date' straight into datetime64
+        df = pd.read_csv(input_file, engine='pyarrow', parse_dates=['date'])
 
     core_dates = get_needed_raster_dates(df, 0)
     precip_dates = get_needed_raster_dates(df)
@@ -255,9 +440,13 @@ if __name__ == "__main__":
     # print(precip_dates)
 
     print("Starting raster-based enrichment...")
-    df = enrich_df_with_rasters(df, ndvi_dir="ndvi/", soil_dir="soil/")
-    df = enrich_with_precip(df, precip_dir="precip/")
-    df = enrich_with_worldcover(df)
+    # Let GDAL keep decoded blocks around while cached handles are reused. Sampling runs in
+    # worker processes, each with its own handle cache and up to GDAL_CACHEMAX MB of block cache
+    with rasterio.Env(GDAL_CACHEMAX=512):
+        df = enrich_df_with_rasters(df, ndvi_dir="ndvi/", soil_dir="soil/")
+        df = enrich_with_precip(df, precip_dir="precip/")
+        df = enrich_with_worldcover(df)
+        close_rasters()
     df = add_worldcover_labels(df)
 
     # 🧠 Fill missing NDVI using same-location fallback
@@ -265,5 +454,6 @@ if __name__ == "__main__":
     df = fill_missing_ndvi(df, max_days_gap=7)
 
     print(f"Saving enriched data to {output_file}...")
-    df.to_csv(output_file, index=False)
+    # Parquet keeps the float32, nullable UInt8 (land_cover) and datetime dtypes for cluster.py and skips text encoding
+    df.to_parquet(output_file, engine='pyarrow', compression='snappy', index=False)
     print("Done ✅")
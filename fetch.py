@@ -4,30 +4,55 @@ from datetime import timedelta
 import os
 import cdsapi
 import zipfile
-import requests
-
-# Initialize the CDS API client to download ERA5-Land data (Soil Moisture)
-def download_era5_soil_moisture(date_str, output_dir="soil/"):
+import shutil
+import xarray as xr
+import asyncio
+import gzip
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from enrich_with_rasters import get_needed_raster_dates
+
+CHIRPS_CONCURRENCY = 8  # simultaneous downloads from data.chc.ucsb.edu
+CDS_WORKERS = 4  # CDS queues requests per account, so more threads don't help
+
+# Initialize the CDS API client once to download ERA5-Land data (Soil Moisture)
+cds_client = cdsapi.Client()
+
+def group_dates_by_month(dates):
+    months = {}
+    for date_str in dates:
+        year, month, day = date_str.split("-")
+        months.setdefault((year, month), []).append(day)
+    return months
+
+def download_era5_soil_moisture(client, year, month, days, output_dir="soil/"):
+    """
+    Downloads ERA5-Land soil moisture for several days of one month with a single CDS request.
+    The combined NetCDF is split into one soil_{date}.nc file per day.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    year, month, day = date_str.split("-")
+    nc_paths = {day: os.path.join(output_dir, f"soil_{year}-{month}-{day}.nc") for day in days}
 
-    c = cdsapi.Client()
+    missing_days = []
+    for day, nc_path in nc_paths.items():
+        if os.path.exists(nc_path):
+            print(f"✅ Already downloaded: {nc_path}")
+        else:
+            missing_days.append(day)
+    if not missing_days:
+        return list(nc_paths.values())
 
-    zip_path = os.path.join(output_dir, f"soil_{date_str}.zip")
-    nc_path = os.path.join(output_dir, f"soil_{date_str}.nc")
+    zip_path = os.path.join(output_dir, f"soil_{year}-{month}.zip")
+    month_nc_path = os.path.join(output_dir, f"soil_{year}-{month}.nc")
 
-    if os.path.exists(nc_path):
-        print(f"✅ Already downloaded: {nc_path}")
-        return nc_path
-
-    print(f"🔽 Downloading ERA5-Land soil moisture for {date_str}...")
+    print(f"🔽 Downloading ERA5-Land soil moisture for {year}-{month} ({len(missing_days)} days)...")
 
     dataset = "reanalysis-era5-land"
     request = {
         "variable": ["volumetric_soil_water_layer_1"],
         "year": year,
         "month": month,
-        "day": [day],
+        "day": missing_days,
         "time": [f"{h:02d}:00" for h in range(24)],  # All 24 hours
         "data_format": "netcdf",
         "area": [42, -106, 39, -102],  # North, West, South, East (bounding box around Colorado, you can adjust)
@@ -35,23 +60,35 @@ def download_era5_soil_moisture(date_str, output_dir="soil/"):
     
     print(request)
 
-    c.retrieve(
+    client.retrieve(
         dataset,
         request,
         zip_path
     )
 
-    # Extract .nc file from the zip
+    # Stream the .nc member straight to this call's own path; every CDS archive uses the same
+    # member name, so extracting into the shared directory would race with other workers
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(output_dir)
-        extracted_files = zip_ref.namelist()
-        extracted_nc = [f for f in extracted_files if f.endswith(".nc")]
-        if extracted_nc:
-            os.rename(os.path.join(output_dir, extracted_nc[0]), nc_path)
+        nc_members = [f for f in zip_ref.namelist() if f.endswith(".nc")]
+        if not nc_members:
+            raise RuntimeError(f"No NetCDF file found in {zip_path}")
+        with zip_ref.open(nc_members[0]) as src, open(month_nc_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
     os.remove(zip_path)
 
-    print(f"✅ Saved NetCDF to {nc_path}")
-    return nc_path
+    # Split the month into the per-day files the enrichment step expects. Each day is written
+    # under a temporary name and renamed into place, so an interrupted run never leaves a
+    # partial file that the "Already downloaded" check would accept
+    with xr.open_dataset(month_nc_path, engine='netcdf4') as ds:
+        time_dim = 'valid_time' if 'valid_time' in ds.dims else 'time'
+        for day in missing_days:
+            tmp_path = nc_paths[day] + ".part"
+            ds.sel({time_dim: f"{year}-{month}-{day}"}).to_netcdf(tmp_path)
+            os.replace(tmp_path, nc_paths[day])
+            print(f"✅ Saved NetCDF to {nc_paths[day]}")
+    os.remove(month_nc_path)
+
+    return list(nc_paths.values())
 
 # Initialize Earth Engine
 ee.Initialize()
@@ -88,7 +125,7 @@ def fetch_sentinel2_ndvi(lat, lon, date_str, output_dir="ndvi/"):
 
     print(f"📦 Started NDVI export task for {date_str} at ({lat},{lon})")
 
-def fetch_chirps_precip(date_str, output_dir="precip/"):
+async def fetch_chirps_precip(session, semaphore, date_str, output_dir="precip/"):
     os.makedirs(output_dir, exist_ok=True)
     out_path = os.path.join(output_dir, f"precip_{date_str}.tif")
     if os.path.exists(out_path):
@@ -96,26 +133,25 @@ def fetch_chirps_precip(date_str, output_dir="precip/"):
 
     year, month, day = date_str.split("-")
     url = f"https://data.chc.ucsb.edu/products/CHIRPS-2.0/global_daily/tifs/p05/{year}/chirps-v2.0.{year}.{month}.{day}.tif.gz"
-    gz_path = out_path + ".gz"
 
     try:
-        print(f"🔽 Downloading CHIRPS for {date_str}...")
-        r = requests.get(url, stream=True, timeout=30)
-        if r.status_code == 404:
-            print(f"⚠️ CHIRPS not available for {date_str}. Skipping.")
-            return None
-        r.raise_for_status()
-
-        with open(gz_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-        # Unzip the file
-        import gzip, shutil
-        with gzip.open(gz_path, 'rb') as f_in, open(out_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-
-        os.remove(gz_path)
+        async with semaphore:
+            print(f"🔽 Downloading CHIRPS for {date_str}...")
+            async with session.get(url) as r:
+                if r.status == 404:
+                    print(f"⚠️ CHIRPS not available for {date_str}. Skipping.")
+                    return None
+                r.raise_for_status()
+                chunks = [chunk async for chunk in r.content.iter_chunked(65536)]
+
+        # Decompress before touching the output, then rename into place, so a bad body
+        # (e.g. an HTML maintenance page) never leaves a file the exists() check would accept
+        data = gzip.decompress(b"".join(chunks))
+        tmp_path = out_path + ".part"
+        with open(tmp_path, 'wb') as f_out:
+            f_out.write(data)
+        os.replace(tmp_path, out_path)
+
         print(f"✅ CHIRPS saved to {out_path}")
         return out_path
 
@@ -123,6 +159,12 @@ def fetch_chirps_precip(date_str, output_dir="precip/"):
         print(f"[!] Error fetching CHIRPS for {date_str}: {e}")
         return None
 
+async def fetch_all_chirps(dates, output_dir="precip/"):
+    semaphore = asyncio.Semaphore(CHIRPS_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        return await asyncio.gather(*(fetch_chirps_precip(session, semaphore, d, output_dir) for d in dates))
+
 def get_unique_dates(df):
     return sorted(pd.to_datetime(df['date'].dropna()).dt.strftime('%Y-%m-%d').unique())
 
@@ -136,6 +178,14 @@ df = pd.read_csv('mushroom_observations.csv')
 #     fetch_sentinel2_ndvi(row['lat'], row['lon'], row['date'])
 
 needed_dates = get_unique_dates(df)
-
-for date_str in needed_dates:
-    download_era5_soil_moisture(date_str)
\ No newline at end of file
+precip_dates = get_needed_raster_dates(df)
+
+# CDS downloads run in a small thread pool while CHIRPS downloads run on the event loop
+with ThreadPoolExecutor(max_workers=CDS_WORKERS) as pool:
+    soil_downloads = [
+        pool.submit(download_era5_soil_moisture, cds_client, year, month, days)
+        for (year, month), days in group_dates_by_month(needed_dates).items()
+    ]
+    asyncio.run(fetch_all_chirps(precip_dates))
+    for future in soil_downloads:
+        future.result()
@@ -2,29 +2,222 @@ from pyinaturalist import get_observations
 import pandas as pd
 from meteostat import Stations, Point, Daily
 from datetime import datetime
-import requests
+import asyncio
+import logging
+import math
+import os
+import shelve
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import orjson
 
 # https://www.inaturalist.org/observations?subview=map
 
-def get_elevation(lat, lon):
-    url = f"https://api.open-elevation.com/api/v1/lookup?locations={lat},{lon}"
-    r = requests.get(url)
-    if r.ok:
-        return r.json()['results'][0]['elevation']
-    return None
-
-def get_weather(lat, lon, date_str):
-    date = datetime.strptime(date_str, '%Y-%m-%d')
-    stations = Stations().nearby(lat,lon).fetch(5)
-
-    for station_id in stations.index:
-        df = Daily(station_id, date, date).fetch()
-        if not df.empty:
-            return df.iloc[0].to_dict() | {'station_used': station_id}
-    return {'station_id': None}
-
-def fetch_inat_data(taxon_name='morchella', quality_grade='research', lat=40.0, lng=-105.0, radius=500.0, per_page=100):
-    results = get_observations(
+logger = logging.getLogger(__name__)
+
+INAT_PAGE_SIZE = 200  # the API's maximum per_page
+INAT_CONCURRENCY = 4  # worker threads fetching pages
+INAT_MAX_RESULTS = 10000  # the API rejects pages past the first 10,000 results
+INAT_REQUESTS_PER_SECOND = 1.0  # iNaturalist's recommended limit for anonymous clients
+ELEVATION_URL = "https://api.open-elevation.com/api/v1/lookup"
+ELEVATION_BATCH_SIZE = 100  # locations per lookup request, keeps request bodies small
+REQUEST_CONCURRENCY = 10  # simultaneous elevation lookups
+ELEVATION_REQUESTS_PER_SECOND = 1.0  # Open-Elevation's public rate limit
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 1.0  # doubled after every failed attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+LOOKUP_CACHE_PATH = '.cache/lookups'  # shelve of elevation and weather results from earlier runs
+COORD_DECIMALS = 5  # ~1 m precision, so repeat visits to the same spot share lookups
+STATION_BUCKET_DEGREES = 0.1  # ~10 km cells share the same nearest stations
+WEATHER_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # keep meteostat's station data files for 30 days
+OUTPUT_CHUNK_ROWS = 1000  # rows serialized per write of the records JSON
+HTTP_HEADERS = {'User-Agent': 'data-map/1.0 (mushroom observation enrichment)'}
+
+# Output column -> meteostat Daily field
+WEATHER_COLUMNS = {
+    'tavg': 'tavg',
+    'tmin': 'tmin',
+    'tmax': 'tmax',
+    'precipitation': 'prcp',
+    'windspeed': 'wspd',
+    'winddirection': 'wdir',
+    'presure': 'pres',
+}
+
+# Historical station data doesn't change, so let meteostat reuse its downloaded files across runs
+Daily.max_age = WEATHER_CACHE_MAX_AGE
+
+class RateLimiter:
+    """
+    Spaces requests at least 1 / rate seconds apart across concurrent tasks.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def retry_delay(retry_after, attempt):
+    # Honour a numeric Retry-After header, otherwise back off exponentially
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return RETRY_BACKOFF_SECONDS * 2 ** attempt
+
+async def fetch_elevation_batch(client, semaphore, limiter, keys):
+    locations = [{'latitude': lat, 'longitude': lon} for lat, lon in keys]
+    async with semaphore:
+        for attempt in range(MAX_RETRIES + 1):
+            await limiter.wait()
+            try:
+                r = await client.post(ELEVATION_URL, json={'locations': locations})
+                if r.is_success:
+                    results = r.json()['results']
+                    if len(results) != len(keys):
+                        raise ValueError(f"got {len(results)} results for {len(keys)} locations")
+                    return {key: result['elevation'] for key, result in zip(keys, results)}
+                error = f"HTTP {r.status_code}"
+                if r.status_code not in RETRY_STATUSES:
+                    break
+                delay = retry_delay(r.headers.get('Retry-After'), attempt)
+            except httpx.TransportError as e:
+                error = str(e) or type(e).__name__
+                delay = retry_delay(None, attempt)
+            except (ValueError, KeyError, TypeError) as e:
+                # A 2xx with an HTML/empty body or an unexpected shape is treated like a transient failure
+                error = f"malformed response: {e!r}"
+                delay = retry_delay(None, attempt)
+
+            if attempt < MAX_RETRIES:
+                print(f"[!] Elevation lookup failed ({error}), retrying in {delay:.0f}s...")
+                await asyncio.sleep(delay)
+
+    print(f"[!] Giving up on elevation for {len(keys)} locations: {error}")
+    return {}
+
+async def get_elevations(client, semaphore, keys):
+    """
+    Looks up the elevation of many (lat, lon) location keys with concurrent batched Open-Elevation requests.
+    Returns a dict keyed by location key.
+    """
+    keys = list(keys)
+    batches = [keys[start:start + ELEVATION_BATCH_SIZE] for start in range(0, len(keys), ELEVATION_BATCH_SIZE)]
+
+    limiter = RateLimiter(ELEVATION_REQUESTS_PER_SECOND)
+    elevations = {}
+    for batch in await asyncio.gather(*(fetch_elevation_batch(client, semaphore, limiter, b) for b in batches)):
+        elevations.update(batch)
+    return elevations
+
+@lru_cache(maxsize=4096)
+def nearest_stations(lat_bucket, lon_bucket):
+    """
+    Returns the ids of the 5 stations nearest the centre of a STATION_BUCKET_DEGREES grid cell.
+    """
+    lat = lat_bucket * STATION_BUCKET_DEGREES
+    lon = lon_bucket * STATION_BUCKET_DEGREES
+    return tuple(Stations().nearby(lat, lon).fetch(5).index)
+
+def get_weather_histories(dates_by_cell):
+    """
+    Fetches daily weather for every station grid cell and date with a single bulk meteostat request.
+    Each date uses the nearest of the cell's stations that has a record for that day.
+    Returns a dict mapping (lat_cell, lon_cell) to {date string: weather}.
+    """
+    if not dates_by_cell:
+        return {}
+
+    stations_by_cell = {cell: nearest_stations(*cell) for cell in dates_by_cell}
+    all_stations = sorted(set().union(*stations_by_cell.values()))
+    # Parse each distinct date string once for the whole batch
+    parsed_dates = {date: datetime.fromisoformat(date) for dates in dates_by_cell.values() for date in dates}
+    start = min(parsed_dates.values())
+    end = max(parsed_dates.values())
+
+    daily = Daily(all_stations, start, end).fetch()
+    if daily.index.nlevels == 1:  # meteostat drops the station level when only one station is requested
+        daily = pd.concat({all_stations[0]: daily}, names=['station'])
+    rows = daily.to_dict('index')  # {(station_id, date): weather}
+
+    weather_by_cell = {}
+    for cell, dates in dates_by_cell.items():
+        weather = {}
+        for date_str in dates:
+            date = parsed_dates[date_str]
+            for station_id in stations_by_cell[cell]:
+                row = rows.get((station_id, date))
+                if row is not None:
+                    weather[date_str] = row | {'station_used': station_id}
+                    break
+        weather_by_cell[cell] = weather
+    return weather_by_cell
+
+async def fetch_observation_pages(per_page=INAT_PAGE_SIZE, **params):
+    """
+    Fetches every page of a get_observations query.
+    A count_only request sizes the query, then the pages are fetched concurrently on a small thread pool.
+    Returns the combined list of observation dicts.
+    """
+    total = (await asyncio.to_thread(get_observations, count_only=True, **params))['total_results']
+    n_pages = math.ceil(min(total, INAT_MAX_RESULTS) / per_page)
+    print(f"Found {total} observations across {n_pages} pages")
+    if total > INAT_MAX_RESULTS:
+        print(f"[!] The API only pages through the first {INAT_MAX_RESULTS} results; narrow the query to fetch the rest")
+
+    loop = asyncio.get_running_loop()
+    limiter = RateLimiter(INAT_REQUESTS_PER_SECOND)
+
+    with ThreadPoolExecutor(max_workers=INAT_CONCURRENCY) as pool:
+        async def fetch_page(page):
+            await limiter.wait()
+            fetch = partial(get_observations, page=page, per_page=per_page, **params)
+            return (await loop.run_in_executor(pool, fetch))['results']
+
+        pages = await asyncio.gather(*(fetch_page(page) for page in range(1, n_pages + 1)))
+    return [obs for page in pages for obs in page]
+
+def load_cached_lookups(cache, keys, dates_by_cell):
+    """
+    Splits the needed lookups into results already in the cache and those still to fetch.
+    Returns (elevations, weather_by_cell, uncached_keys, uncached_dates_by_cell).
+    """
+    elevations = {}
+    uncached_keys = []
+    for key in keys:
+        cache_key = f"elevation:{key[0]},{key[1]}"
+        if cache_key in cache:
+            elevations[key] = cache[cache_key]
+        else:
+            uncached_keys.append(key)
+
+    weather_by_cell = {}
+    uncached_dates_by_cell = {}
+    for cell, dates in dates_by_cell.items():
+        for date in dates:
+            cache_key = f"weather_cell:{cell[0]},{cell[1]},{date}"
+            if cache_key in cache:
+                weather_by_cell.setdefault(cell, {})[date] = cache[cache_key]
+            else:
+                uncached_dates_by_cell.setdefault(cell, set()).add(date)
+
+    return elevations, weather_by_cell, uncached_keys, uncached_dates_by_cell
+
+def store_cached_lookups(cache, elevations, weather_by_cell):
+    for key, elevation in elevations.items():
+        cache[f"elevation:{key[0]},{key[1]}"] = elevation
+    for cell, weather in weather_by_cell.items():
+        for date, day in weather.items():
+            cache[f"weather_cell:{cell[0]},{cell[1]},{date}"] = day
+
+async def fetch_inat_data(taxon_name='morchella', quality_grade='research', lat=40.0, lng=-105.0, radius=500.0, per_page=INAT_PAGE_SIZE):
+    observations = await fetch_observation_pages(
         taxon_name=taxon_name,
         lat=lat,
         lng=lng,
@@ -35,51 +228,142 @@ def fetch_inat_data(taxon_name='morchella', quality_grade='research', lat=40.0,
         per_page=per_page,
     )
 
-    observations = []
-    for obs in results['results']:
-        timestamp = obs.get('observed_on')
-        if isinstance(timestamp, datetime):
-            date = timestamp.strftime('%Y-%m-%d')
-        elif not timestamp:  # Handle missing or None dates
-            date = None
-
-        coords = obs['geojson']['coordinates'] if 'geojson' in obs else [None, None]
-        elevation = get_elevation(coords[1], coords[0])
-        weather = get_weather(coords[1], coords[0], date) if coords[0] and coords[1] and date else {}
-        if not isinstance(weather, dict):  # Safeguard against unexpected types
-            weather = {}
-            print(f"Unexpected weather data type: {type(weather)}")
-            
-        print(weather)
-
-        observations.append({
-            'uuid': obs.get('uuid'),
-            'timestamp': timestamp,
-            'date': date,
-            'lon': coords[0],
-            'lat': coords[1],
-            'elevation': elevation,
-            'tavg': weather.get('tavg', None),
-            'tmin': weather.get('tmin', None),
-            'tmax': weather.get('tmax', None),
-            'precipitation': weather.get('prcp', None),
-            'windspeed': weather.get('wspd', None),
-            'winddirection': weather.get('wdir', None),
-            'presure': weather.get('pres', None),
-            'species': obs.get('taxon', {}).get('name', ''),
-            'location': obs.get('place_guess', ''),
-            'num_identification_agreements': obs.get('num_identification_agreements', 0),
-        })
-
-    df = pd.DataFrame(observations)
+    # Flatten the nested observation dicts into columns in one pass
+    raw = pd.json_normalize(observations, max_level=1)
+
+    def field(name, default=None):
+        return raw[name] if name in raw else pd.Series(default, index=raw.index, dtype=object)
+
+    observed_on = field('observed_on')
+    coords = field('geojson.coordinates')
+    df = pd.DataFrame({
+        'uuid': field('uuid'),
+        'timestamp': observed_on.infer_objects(),
+        # Local calendar date, taken from each timestamp's own UTC offset
+        'date': observed_on.astype(str).str[:10].where(observed_on.notna()),
+        'lon': pd.to_numeric(coords.str[0]).astype('float64'),
+        'lat': pd.to_numeric(coords.str[1]).astype('float64'),
+    })
+    # Only valid coordinates reach the elevation and weather lookups; the rest keep empty columns
+    located = df['lat'].between(-90, 90) & df['lon'].between(-180, 180)
+    skipped = (~located | df['date'].isna()).sum()
+    if skipped:
+        print(f"[!] {skipped} observations lack valid coordinates or a date; skipping their lookups")
+    df['lat_key'] = df['lat'].round(COORD_DECIMALS).where(located)
+    df['lon_key'] = df['lon'].round(COORD_DECIMALS).where(located)
+
+    # Weather only depends on the station grid cell, so every location in a cell shares its lookups
+    df['lat_cell'] = (df['lat'].where(located) / STATION_BUCKET_DEGREES).round().astype('Int64')
+    df['lon_cell'] = (df['lon'].where(located) / STATION_BUCKET_DEGREES).round().astype('Int64')
+    dated = df.dropna(subset=['lat_cell', 'lon_cell', 'date'])
+    dates_by_cell = {
+        (int(lat_cell), int(lon_cell)): dates
+        for (lat_cell, lon_cell), dates in dated.groupby(['lat_cell', 'lon_cell'])['date'].agg(set).items()
+    }
+    location_keys = set(df.loc[located, ['lat_key', 'lon_key']].itertuples(index=False, name=None))
+
+    os.makedirs(os.path.dirname(LOOKUP_CACHE_PATH), exist_ok=True)
+    with shelve.open(LOOKUP_CACHE_PATH) as cache:
+        elevations, weather_by_cell, uncached_keys, uncached_dates = load_cached_lookups(
+            cache, location_keys, dates_by_cell
+        )
+        print(f"Lookup cache: {len(elevations)} elevations, {sum(map(len, weather_by_cell.values()))} weather days reused")
+
+        # Elevation batches run concurrently while the bulk weather fetch blocks a worker thread
+        semaphore = asyncio.Semaphore(REQUEST_CONCURRENCY)
+        loop = asyncio.get_running_loop()
+        # One pooled HTTP/2 client multiplexes the batches over kept-alive connections
+        limits = httpx.Limits(
+            max_connections=REQUEST_CONCURRENCY,
+            max_keepalive_connections=REQUEST_CONCURRENCY,
+            keepalive_expiry=60,
+        )
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=30, headers=HTTP_HEADERS) as client:
+            new_elevations, new_weather = await asyncio.gather(
+                get_elevations(client, semaphore, uncached_keys),
+                loop.run_in_executor(None, get_weather_histories, uncached_dates),
+            )
+
+        store_cached_lookups(cache, new_elevations, new_weather)
+        elevations.update(new_elevations)
+        for cell, weather in new_weather.items():
+            weather_by_cell.setdefault(cell, {}).update(weather)
+
+    # Join elevation back by location and weather by station cell and date
+    elevation_table = pd.DataFrame(
+        [(lat_key, lon_key, elevation) for (lat_key, lon_key), elevation in elevations.items()],
+        columns=['lat_key', 'lon_key', 'elevation'],
+    ).astype({'lat_key': 'float64', 'lon_key': 'float64'})
+    weather_table = pd.DataFrame(
+        [
+            (lat_cell, lon_cell, date, *(weather.get(name) for name in WEATHER_COLUMNS.values()))
+            for (lat_cell, lon_cell), days in weather_by_cell.items()
+            for date, weather in days.items()
+        ],
+        columns=['lat_cell', 'lon_cell', 'date', *WEATHER_COLUMNS],
+    ).astype({'lat_cell': 'Int64', 'lon_cell': 'Int64', 'date': df['date'].dtype})
+    df = (
+        df.merge(elevation_table, on=['lat_key', 'lon_key'], how='left')
+          .merge(weather_table, on=['lat_cell', 'lon_cell', 'date'], how='left')
+          .drop(columns=['lat_key', 'lon_key', 'lat_cell', 'lon_cell'])
+    )
+    df = df.astype({'elevation': 'float32', **dict.fromkeys(WEATHER_COLUMNS, 'float32')})
+    logger.debug("Joined weather for %d of %d observations", df['tavg'].notna().sum(), len(df))
+
+    df['species'] = field('taxon.name', '').fillna('').to_numpy()
+    df['location'] = field('place_guess', '').to_numpy()
+    df['num_identification_agreements'] = field('num_identification_agreements', 0).fillna(0).astype('int64').to_numpy()
     return df
 
+def json_records(df):
+    """
+    Converts df into a list of record dicts that orjson can serialize directly.
+    Numeric columns stay as numpy values; datetimes and missing objects become ISO strings / None.
+    """
+    columns = {}
+    for name, series in df.items():
+        values = series.to_numpy()
+        if values.dtype == object or values.dtype.kind == 'M':
+            values = series.astype(object).where(series.notna(), None).to_numpy()
+        columns[name] = values
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+def write_records_json(df, path, chunk_size=OUTPUT_CHUNK_ROWS):
+    """
+    Writes df as a JSON array of records with orjson, serializing chunk_size rows at a time
+    so the whole document is never held in memory as one string.
+    """
+    with open(path, 'wb') as f:
+        f.write(b'[')
+        for start in range(0, len(df), chunk_size):
+            records = orjson.dumps(
+                json_records(df.iloc[start:start + chunk_size]),
+                option=orjson.OPT_SERIALIZE_NUMPY,
+                default=lambda value: value.isoformat(),
+            )
+            if start:
+                f.write(b',')
+            f.write(records[1:-1])
+        f.write(b']')
+
+def write_parquet(df, path):
+    """
+    Writes df as snappy-compressed Parquet for the enrichment step.
+    Timestamps are normalized to UTC (offsets vary across DST) and dates stored as datetime64.
+    """
+    df.assign(
+        timestamp=pd.to_datetime(df['timestamp'], utc=True),
+        date=pd.to_datetime(df['date']),
+    ).to_parquet(path, engine='pyarrow', compression='snappy', index=False)
+
 print("Fetching iNaturalist data...")
-df_inat = fetch_inat_data()
+df_inat = asyncio.run(fetch_inat_data())
 print("Data fetched successfully.")
 # print(df_inat.head())
 print("Saving data to CSV...")
 df_inat.to_csv('mushroom_observations.csv', index=False)
 print("Saving data to GeoJSON...")
-df_inat.to_json('mushroom_observations.geojson', orient='records')
+write_records_json(df_inat, 'mushroom_observations.geojson')
+print("Saving data to Parquet...")
+write_parquet(df_inat, 'mushroom_observations.parquet')
 print("Data saved successfully.")
\ No newline at end of file